@@ -19,20 +19,41 @@ GNU General Public License for more details.
 
 """
 import os
+import gc
 import json
+import atexit
+import shutil
+import tempfile
 import numpy as np
 import matplotlib
 matplotlib.use("AGG")
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import scipy.stats as st
+from scipy.fft import next_fast_len, rfft, irfft
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # Optional, see _accumulate_lfp
+    HAVE_NUMBA = False
+try:
+    import cupy
+except ImportError:
+    # Optional, only needed with use_gpu=True
+    cupy = None
 
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
+# MPI message tags used for dynamic distribution of pathway kernels:
+TAG_REQUEST = 1
+TAG_WORK = 2
 
 # (NEURON MUST BE IMPORTED AFTER MPI SOMETIMES)
 import neuron
+from neuron import h
 from lfpykernels import KernelApprox, GaussCylinderPotential
 
 import userland
@@ -81,7 +102,7 @@ class PotjansDiesmannKernels:
     """
 
     def __init__(self, spike_recorder_ids, sim_savefolder=None, fig_folder=None,
-                 overwrite_kernels=False):
+                 overwrite_kernels=False, use_gpu=False):
 
         # The parameters of the model and simulation are given by these
         # dictionaries:
@@ -108,6 +129,26 @@ class PotjansDiesmannKernels:
         self.plot_conn_data = True
         self.plot_kernels = True
         self.plot_firing_rate = False
+        # Precision of the firing rates, kernels and LFP. The LFP is a
+        # linear filtering of the firing rates, and single precision is
+        # sufficient:
+        self.lfp_dtype = np.float32
+        # Postsynaptic cell and population setup, see _get_postsyn_setup:
+        self._cell_cache = {}
+        # Figure reused by all firing rate and LFP plots, see _plot_fr_and_lfp
+        self._diag_fig = None
+        # With use_gpu, the kernel spectra and the LFP are kept on the GPU,
+        # and the convolutions are done there. The firing rates stay on
+        # the host, where the spikes are received:
+        self.use_gpu = use_gpu
+        if self.use_gpu:
+            if cupy is None:
+                raise ImportError("use_gpu=True requires CuPy")
+            self.xp = cupy
+            self._rfft, self._irfft = cupy.fft.rfft, cupy.fft.irfft
+        else:
+            self.xp = np
+            self._rfft, self._irfft = rfft, irfft
 
         with open(binzegger_file) as f:
             conn_dict = json.load(f)
@@ -125,10 +166,27 @@ class PotjansDiesmannKernels:
         comm.Barrier()
         self._load_pathway_kernels()
         self._find_kernels()
-
-        self.fr_dict = {pop_name: np.zeros(len(self.tvec))
-                        for pop_name in self.presyn_pops}
-        self.lfp = np.zeros((self.num_elecs, len(self.tvec)))
+        self._prepare_kernel_fft()
+
+        # Firing rates of all presynaptic populations, with shape
+        # (num_presyn_pops, len(tvec)). fr_dict gives views of each row:
+        self.fr = np.zeros((len(self.presyn_pops), len(self.tvec)),
+                           dtype=self.lfp_dtype)
+        self.fr_dict = {pop_name: self.fr[pop_idx]
+                        for pop_idx, pop_name in enumerate(self.presyn_pops)}
+        # The LFP is accumulated in a buffer that is padded by
+        # kernel_length beyond the last time step, so that the
+        # contribution from a spike buffer always fits. self.lfp is a view
+        # of the part of the buffer covering self.tvec:
+        lfp_buffer_shape = (self.num_elecs,
+                            len(self.tvec) + self.kernel_length)
+        if self.use_gpu:
+            self._lfp_buffer = cupy.zeros(lfp_buffer_shape,
+                                          dtype=self.lfp_dtype)
+        else:
+            self._lfp_buffer = aligned_zeros(lfp_buffer_shape,
+                                             dtype=self.lfp_dtype)
+        self.lfp = self._lfp_buffer[:, :len(self.tvec)]
         # self._load_firing_rates_from_file()
         # self.plot_lfps()
 
@@ -145,11 +203,19 @@ class PotjansDiesmannKernels:
 
         # Convert postsynaptic potential into postsynaptic current
         # function "postsynaptic_potential_to_current", Potjans2014/helpers.py
-        sub = 1. / (self.tau_syn - self.tau_m)
-        pre = self.tau_m * self.tau_syn / self.C_m * sub
-        frac = (self.tau_m / self.tau_syn) ** sub
-        self.PSC_over_PSP = 1. / (pre * (frac ** self.tau_m -
-                                         frac ** self.tau_syn)) * 1e-3  # nA
+        if self.tau_m == self.tau_syn:
+            # Limit of the expression below for tau_syn -> tau_m
+            self.PSC_over_PSP = np.e * self.C_m / self.tau_m * 1e-3  # nA
+        else:
+            # Evaluated in the log-domain, as
+            # frac**tau_m - frac**tau_syn = frac**tau_syn * (frac**(tau_m - tau_syn) - 1),
+            # to avoid cancellation when tau_m is close to tau_syn
+            sub = 1. / (self.tau_syn - self.tau_m)
+            pre = self.tau_m * self.tau_syn / self.C_m * sub
+            log_frac = sub * (np.log(self.tau_m) - np.log(self.tau_syn))
+            denom = np.expm1((self.tau_m - self.tau_syn) * log_frac) * \
+                np.exp(self.tau_syn * log_frac)
+            self.PSC_over_PSP = 1. / (pre * denom) * 1e-3  # nA
 
     def _set_kernel_params(self):
         """
@@ -193,6 +259,9 @@ class PotjansDiesmannKernels:
 
         self.presyn_pops = pop_names + ['TC']
         self.postsyn_pops = pop_names
+        # Reverse lookup from population name to index:
+        self.presyn_pop_idx = {p: i for i, p in enumerate(self.presyn_pops)}
+        self.postsyn_pop_idx = {p: i for i, p in enumerate(self.postsyn_pops)}
 
         self.pop_IDs = {spike_recorder_id: pop_name
                         for spike_recorder_id, pop_name in zip(spike_recorder_ids, self.presyn_pops)}
@@ -204,12 +273,14 @@ class PotjansDiesmannKernels:
             print("Scaling population sizes by factor {:1.2f}".format(
                 self.net_dict['N_scaling']))
 
-        pop_sizes = np.array(self.net_dict['full_num_neurons']) * \
-            self.net_dict['N_scaling']
-        self.pop_sizes = np.r_[pop_sizes,
-                               [self.stim_dict["num_th_neurons"]]]
 
         self.layers = ["1", "23", "4", "5", "6"]
+        self.layer_idx = {l: i for i, l in enumerate(self.layers)}
+        # Row l_idx gives all input to layer l_idx:
+        self._eye_layers = np.eye(len(self.layers))
+        # Layer index of each (cortical) population, e.g. 'L23E' -> 1:
+        self.pop_layer_idx = {p: self.layer_idx[p[1:-1]]
+                              for p in self.postsyn_pops}
         self.layer_boundaries = {
             "1": [0.0, -81.6],
             "23": [-81.6, -587.1],
@@ -224,6 +295,36 @@ class PotjansDiesmannKernels:
                                   self.layer_boundaries[layer][1]
                                   for layer in self.layers]
 
+        # Per-population scalar attributes, stored as one structured array
+        # indexed by presynaptic population index. The thalamic (TC)
+        # population is not placed in any cortical layer:
+        self.pop_arr = np.empty(len(self.presyn_pops),
+                                dtype=[('size', 'f8'), ('layer_mid', 'f8'),
+                                       ('layer_thick', 'f8')])
+        self.pop_arr['size'][:-1] = np.array(self.net_dict['full_num_neurons']) * \
+            self.net_dict['N_scaling']
+        self.pop_arr['size'][-1] = self.stim_dict["num_th_neurons"]
+        self.pop_arr['layer_mid'][-1] = np.nan
+        self.pop_arr['layer_thick'][-1] = np.nan
+        for pop_idx, pop_name in enumerate(self.postsyn_pops):
+            l_idx = self.pop_layer_idx[pop_name]
+            self.pop_arr['layer_mid'][pop_idx] = self.layer_mids[l_idx]
+            self.pop_arr['layer_thick'][pop_idx] = self.layer_thicknesses[l_idx]
+        self.pop_sizes = self.pop_arr['size']
+
+        # For mathematical convenience, the spatial spread of the
+        # somas and synapses in the depth direction (z-axis) are treated
+        # as gaussians, with a standard deviation
+        # of layer_thickness/spatial_spread_dz. The spatial_spread_dz parameter
+        # is important in deciding the resulting LFP amplitude, with a larger
+        # value giving higher LFP amplitudes.
+        self.spatial_spread_dz = 4
+        # Synapse position functions for each layer, shared by all pathways:
+        self._layer_funs = [st.norm] * len(self.layers)
+        self._layer_funargs = [dict(loc=self.layer_mids[l_idx],
+                                    scale=self.layer_thicknesses[l_idx] / self.spatial_spread_dz)
+                               for l_idx in range(len(self.layers))]
+
         self.subpop_dict = {
             'L23E': ['p23'],
             'L23I': ['b23', 'nb23'],
@@ -294,6 +395,60 @@ class PotjansDiesmannKernels:
                         :len(self.postsyn_pops)] = self.net_dict['conn_probs']
         self.conn_probs[:, -1] = self.stim_dict['conn_probs_th']
 
+        # Synaptic parameters of each pathway, with shape
+        # (num_postsyn_pops, num_presyn_pops), including the TC column:
+        self.PSP_mean_full = np.empty_like(self.conn_probs)
+        self.PSP_mean_full[:, :-1] = self.net_dict['PSP_matrix_mean']
+        self.PSP_mean_full[:, -1] = self.stim_dict['PSP_th']
+        self.delay_mean_full = np.empty_like(self.conn_probs)
+        self.delay_mean_full[:, :-1] = self.net_dict['delay_matrix_mean']
+        self.delay_mean_full[:, -1] = self.stim_dict['delay_th_mean']
+        self.delay_rel_std_full = np.empty(len(self.presyn_pops))
+        self.delay_rel_std_full[:-1] = self.net_dict['delay_rel_std']
+        self.delay_rel_std_full[-1] = self.stim_dict['delay_th_rel_std']
+
+        # Kernel file name of each (postsyn_pop, presyn_pop) pathway:
+        self._kernel_files = {
+            (postsyn_pop, presyn_pop): os.path.join(
+                self.sim_saveforlder, f'kernel_{postsyn_pop}:{presyn_pop}.npy')
+            for postsyn_pop in self.postsyn_pops
+            for presyn_pop in self.presyn_pops}
+
+        # Only pathways with non-zero connection probability need a kernel:
+        nonzero_pathways = np.argwhere(np.abs(self.conn_probs) >= 1e-9)
+        self._pathway_tasks = [(self.postsyn_pops[i], self.presyn_pops[j])
+                               for i, j in nonzero_pathways]
+
+    def _prefetch_morphologies(self):
+        """
+        Read the morphology and template files once on rank 0, broadcast
+        them to all ranks, and store them in a local temporary folder on
+        each rank. The cell models are then loaded from this folder, which
+        avoids repeated reads from a (possibly slow, shared) file system.
+        Only needed when pathway kernels are calculated, see
+        _calculate_all_pathway_kernels. Must be called on all ranks.
+        """
+        file_names = sorted(set(self.morph_map.values()))
+        if rank == 0:
+            morph_bytes = {}
+            for f_name in file_names:
+                with open(os.path.join(morphology_folder, f_name), 'rb') as f:
+                    morph_bytes[f_name] = f.read()
+            with open(os.path.join(template_folder,
+                                   'LFPyCellTemplate.hoc'), 'rb') as f:
+                morph_bytes['LFPyCellTemplate.hoc'] = f.read()
+        else:
+            morph_bytes = None
+        morph_bytes = comm.bcast(morph_bytes, root=0)
+
+        self._morph_folder = tempfile.mkdtemp(prefix=f'morphologies_{rank}_')
+        atexit.register(shutil.rmtree, self._morph_folder, ignore_errors=True)
+        for f_name, f_bytes in morph_bytes.items():
+            with open(os.path.join(self._morph_folder, f_name), 'wb') as f:
+                f.write(f_bytes)
+        # The file contents are not kept in memory after writing them
+        del morph_bytes
+
     def _find_layer_specific_pathways(self):
         """
         We need to find the normalized layer-specific input for each
@@ -309,134 +464,172 @@ class PotjansDiesmannKernels:
         each post-synaptic subpopulation.
         """
 
-        # Prepare layer-specific input distribution array for each
-        # post-synaptic subpopulation
-        syn_pathways_subpops = {}
-        for postsyn_pop in self.postsyn_pops:
-            for postsyn_subpop in self.subpop_dict[postsyn_pop]:
-                for presyn_pop in self.presyn_pops:
-                    subpop_pathway_name = f'{postsyn_subpop}:{presyn_pop}'
-                    syn_pathways_subpops[subpop_pathway_name] = np.zeros(5)
-
-        # Find number of inputs to each layer for each
+        # Postsynaptic subpopulations (y) in the order of self.postsyn_pops,
+        # and all considered presynaptic subpopulations (x):
+        postsyn_subpops = [postsyn_subpop for postsyn_pop in self.postsyn_pops
+                           for postsyn_subpop in self.subpop_dict[postsyn_pop]]
+        all_subpops = list(self.subpop_mapping_dict.keys())
+        # Index of the presynaptic population (X) of each subpopulation (x):
+        subpop_to_pop_idx = np.array([
+            self.presyn_pop_idx[self.subpop_mapping_dict[subpop]]
+            for subpop in all_subpops])
+
+        num_layers = len(self.layers)
+        # Percentage-wise input from each presynaptic subpopulation (P),
+        # and total number of synapses (K), to each layer of each
         # post-synaptic subpopulation:
-        for postsyn_pop in self.postsyn_pops:
-            for postsyn_subpop in self.subpop_dict[postsyn_pop]:
-                for l_idx, layer in enumerate(self.layers):
-                    if layer in self.conn_data[postsyn_subpop]['syn_dict']:
-                        conn_data_yL = self.conn_data[postsyn_subpop]['syn_dict'][layer]
-                        sum_ = 0
-                        # Total number of synapses to this layer of this subpopulation:
-                        k_yL = conn_data_yL['number of synapses per neuron']
-                        for p in conn_data_yL:
-                            if not p == 'number of synapses per neuron':
-                                sum_ += conn_data_yL[p]
-                            # Include all considered presynaptic populations:
-                            if p in self.subpop_names:
-                                p_yxL = conn_data_yL[p]
-                                # Number of synapses from presynaptic subpopulation
-                                # to this layer of the postsynaptic subpopulation:
-                                k_xyL = (p_yxL / 100) * k_yL
-
-                                # Number of inputs from each included presynaptic
-                                # population to this layer is summed:
-                                presyn_pop = self.subpop_mapping_dict[p]
-                                subpop_pathway_name = f'{postsyn_subpop}:{presyn_pop}'
-                                syn_pathways_subpops[subpop_pathway_name][l_idx] += k_xyL
-                        # Sanity check that sum of all percentage-wise input to this layer of this
-                        # subpopulation sums to 100 %:
-                        assert np.round(sum_) == 100.0
-
-        # Normalize layer-specific input for each postsynaptic population:
-        for subpop_pathway_name in syn_pathways_subpops.keys():
-            if np.sum(syn_pathways_subpops[subpop_pathway_name]) > 0.0:
-                syn_pathways_subpops[subpop_pathway_name] /= np.sum(
-                    syn_pathways_subpops[subpop_pathway_name])
-
-        # Make a dictionary with the relative fraction of
-        # each subpopulation within a population:
-        subpop_rel_frac = {}
-        for pop_name in self.presyn_pops:
-            rel_frac = []
-            for subpop in self.subpop_dict[pop_name]:
-                rel_frac.append(self.conn_data[subpop]['occurrence'])
-            subpop_rel_frac[pop_name] = np.array(rel_frac) / np.sum(rel_frac)
+        P = np.zeros((len(postsyn_subpops), len(all_subpops), num_layers))
+        K = np.zeros((len(postsyn_subpops), num_layers))
+        for y_idx, postsyn_subpop in enumerate(postsyn_subpops):
+            syn_dict = self.conn_data[postsyn_subpop]['syn_dict']
+            for l_idx, layer in enumerate(self.layers):
+                if layer not in syn_dict:
+                    continue
+                conn_data_yL = syn_dict[layer]
+                K[y_idx, l_idx] = conn_data_yL['number of synapses per neuron']
+                P[y_idx, :, l_idx] = [conn_data_yL.get(subpop, 0.0)
+                                      for subpop in all_subpops]
+                # Sanity check that sum of all percentage-wise input to this
+                # layer of this subpopulation sums to 100 %:
+                sum_ = np.sum([conn_data_yL[p] for p in conn_data_yL
+                               if not p == 'number of synapses per neuron'])
+                assert np.round(sum_) == 100.0
+
+        # Number of synapses from each presynaptic subpopulation
+        # to each layer of each postsynaptic subpopulation:
+        k_yxL = (P / 100) * K[:, None, :]
+
+        # Number of inputs from each included presynaptic
+        # population to each layer is summed:
+        syn_pathways_subpops = np.zeros((len(postsyn_subpops),
+                                         len(self.presyn_pops), num_layers))
+        np.add.at(syn_pathways_subpops,
+                  (slice(None), subpop_to_pop_idx, slice(None)), k_yxL)
+
+        # Normalize layer-specific input for each postsynaptic subpopulation:
+        sum_yX = syn_pathways_subpops.sum(axis=2, keepdims=True)
+        np.divide(syn_pathways_subpops, sum_yX, out=syn_pathways_subpops,
+                  where=sum_yX > 0.0)
+
+        # Matrix with the relative fraction of each
+        # subpopulation (y) within a population (Y):
+        subpop_rel_frac = np.zeros((len(self.postsyn_pops),
+                                    len(postsyn_subpops)))
+        y_idx = 0
+        for pop_idx, pop_name in enumerate(self.postsyn_pops):
+            rel_frac = np.array([self.conn_data[subpop]['occurrence']
+                                 for subpop in self.subpop_dict[pop_name]])
+            subpop_rel_frac[pop_idx, y_idx:y_idx + len(rel_frac)] = \
+                rel_frac / np.sum(rel_frac)
+            y_idx += len(rel_frac)
 
         # Add postsynaptic subpopulations weighted by relative occurrence.
-        # The resulting dictionary 'syn_pathways' contains the
+        # The resulting array 'syn_pathways' with shape
+        # (num_postsyn_pops, num_presyn_pops, num_layers) contains the
         # normalized layer-specific synaptic distribution
         # for each synaptic pathway:
-        self.syn_pathways = {}
-        for postsyn_pop in self.postsyn_pops:
-            for presyn_pop in self.presyn_pops:
-                pathway_name = f'{postsyn_pop}:{presyn_pop}'
-                self.syn_pathways[pathway_name] = np.zeros(5)
-                for p_idx_, postsyn_subpop in enumerate(
-                        self.subpop_dict[postsyn_pop]):
-                    subpop_pathway_name = f'{postsyn_subpop}:{presyn_pop}'
-                    rel_frac_ = subpop_rel_frac[postsyn_pop][p_idx_]
-                    self.syn_pathways[pathway_name] += syn_pathways_subpops[
-                                                                subpop_pathway_name] * rel_frac_
+        self.syn_pathways = np.einsum('Yy,yXL->YXL', subpop_rel_frac,
+                                      syn_pathways_subpops)
 
         if self.plot_conn_data and rank == 0:
+            fig_path = os.path.join(self.fig_folder,
+                                    "layer_specific_conn_data.png")
+            if (os.path.isfile(fig_path) and not self.overwrite_kernels and
+                    os.path.getmtime(fig_path) >= os.path.getmtime(binzegger_file)):
+                # Figure is up to date with the connectivity data
+                return
             # Plot layer-specific connectivity data, similar
             # to Fig. 5D in Hagen et al. (2016) https://doi.org/10.1093/cercor/bhw237
-            fig = plt.figure(figsize=[10, 10])
-            fig.subplots_adjust(wspace=0.3, hspace=0.2, bottom=0.05,
-                                top=0.95, right=0.98, left=0.05)
-            plot_idx = 1
             num_rows = 4
             num_cols = 4
-            for postsyn_pop in self.postsyn_pops:
-                for postsyn_subpop in self.subpop_dict[postsyn_pop]:
-                    conn_matrix = np.zeros((len(self.layers),
-                                            len(self.presyn_pops)))
-                    presyn_pops_reordered = ["TC"] + self.postsyn_pops
-                    for pre_idx, presyn_pop in enumerate(presyn_pops_reordered):
-                        subpop_pathway_name = f'{postsyn_subpop}:{presyn_pop}'
-                        conn_matrix[:, pre_idx] = syn_pathways_subpops[
-                            subpop_pathway_name]
-
-                    ax = fig.add_subplot(num_rows, num_cols, plot_idx,
-                                         title=f'$y$={postsyn_subpop}')
-                    ax.set_xticks(np.arange(len(presyn_pops_reordered)))
-                    ax.set_xticklabels(presyn_pops_reordered, rotation=-90)
-                    ax.set_yticks(np.arange(len(self.layers)))
-                    ax.set_yticklabels(self.layers)
-                    ax.set_xlabel("$X$")
-                    ax.set_ylabel("$L$")
-                    ax.imshow(conn_matrix, cmap="hot", vmax=1, vmin=0)
-
-                    plot_idx += 1
-            plt.savefig(os.path.join(self.fig_folder,
-                                     "layer_specific_conn_data.png"))
+            fig, axes = plt.subplots(num_rows, num_cols, figsize=[10, 10])
+            fig.subplots_adjust(wspace=0.3, hspace=0.2, bottom=0.05,
+                                top=0.95, right=0.98, left=0.05)
+            presyn_pops_reordered = ["TC"] + self.postsyn_pops
+            reorder_idx = [self.presyn_pop_idx[presyn_pop]
+                           for presyn_pop in presyn_pops_reordered]
+            for y_idx, postsyn_subpop in enumerate(postsyn_subpops):
+                conn_matrix = syn_pathways_subpops[y_idx][reorder_idx].T
+
+                ax = axes.flat[y_idx]
+                ax.set_title(f'$y$={postsyn_subpop}')
+                ax.set_xticks(np.arange(len(presyn_pops_reordered)))
+                ax.set_xticklabels(presyn_pops_reordered, rotation=-90)
+                ax.set_yticks(np.arange(len(self.layers)))
+                ax.set_yticklabels(self.layers)
+                ax.set_xlabel("$X$")
+                ax.set_ylabel("$L$")
+                ax.imshow(conn_matrix, cmap="hot", vmax=1, vmin=0,
+                          interpolation='nearest')
+            fig.savefig(fig_path)
+
+    def _get_postsyn_setup(self, postsyn_pop):
+        """
+        Returns the cell parameters, population parameters and
+        extracellular probe of a postsynaptic population. These only
+        depend on the postsynaptic population, so they are created once
+        and reused for all presynaptic populations. Notably, the probe
+        keeps its transformation matrix, which is expensive to calculate,
+        see CachedGaussCylinderPotential.
+        """
+        if postsyn_pop not in self._cell_cache:
+            postsyn_pop_idx = self.postsyn_pop_idx[postsyn_pop]
+
+            # Parameters for a chosen representative post-synaptic cell model:
+            cell_params = dict(
+                morphology=os.path.join(self._morph_folder,
+                                        self.morph_map[postsyn_pop]),
+                templatename='LFPyCellTemplate',
+                templatefile=os.path.join(self._morph_folder, 'LFPyCellTemplate.hoc'),
+                v_init=self.E_L,
+                cm=1.0,
+                Ra=150,
+                passive=True,
+                passive_parameters=dict(g_pas=1. / (self.tau_m * 1E3),  # assume cm=1
+                                        e_pas=self.E_L),
+                nsegs_method='lambda_f',
+                lambda_f=100,
+                dt=self.dt,
+                delete_sections=True,
+                templateargs=None,
+            )
+
+            # Parameters for the postsynaptic population, see
+            # self.spatial_spread_dz in _prepare_populations:
+            population_area = 1000**2  # Potians Diesmann model has area of 1000 µm^2
+            population_params = dict(
+                radius=np.sqrt(population_area / np.pi),  # population radius
+                loc=self.pop_arr['layer_mid'][postsyn_pop_idx],  # population center along z-axis
+                scale=self.pop_arr['layer_thick'][postsyn_pop_idx] / self.spatial_spread_dz)  # SD along z-axis
+
+            gauss_cyl_potential = CachedGaussCylinderPotential(
+                cell=None,
+                z=self.elec_params['z'],
+                sigma=self.elec_params['sigma'],
+                R=population_params['radius'],
+                sigma_z=population_params['scale'],
+            )
+            self._cell_cache[postsyn_pop] = (cell_params, population_params,
+                                             gauss_cyl_potential)
+        return self._cell_cache[postsyn_pop]
 
     def _calculate_one_pathway_kernel(self, postsyn_pop, presyn_pop):
         """
         Calculate the LFP kernel for one specific connection pathway from the
-        presynaptic population to the postsynaptic population
+        presynaptic population to the postsynaptic population.
+        Existing kernels are skipped by _calculate_all_pathway_kernels.
         """
 
-        postsyn_pop_idx = np.where([p_ == postsyn_pop
-                                    for p_ in self.postsyn_pops])[0][0]
-        presyn_pop_idx = np.where([p_ == presyn_pop
-                                   for p_ in self.presyn_pops])[0][0]
-
-        postsyn_l_idx = np.where([l_ == postsyn_pop[1:-1]
-                                  for l_ in self.layers])[0][0]
-        pathway_name = f'{postsyn_pop}:{presyn_pop}'
-        filename = os.path.join(self.sim_saveforlder,
-                                f'kernel_{pathway_name}.npy')
+        postsyn_pop_idx = self.postsyn_pop_idx[postsyn_pop]
+        presyn_pop_idx = self.presyn_pop_idx[presyn_pop]
+        postsyn_l_idx = self.pop_layer_idx[postsyn_pop]
+        filename = self._kernel_files[(postsyn_pop, presyn_pop)]
 
         if np.abs(self.conn_probs[postsyn_pop_idx, presyn_pop_idx]) < 1e-9:
             # No pathway from presyn_pop to postsyn_pop
             return
 
-        if os.path.isfile(filename) and not self.overwrite_kernels:
-            # Kernel already exists, and we do not overwrite it
-            return
-
-        layered_input = self.syn_pathways[pathway_name]
+        layered_input = self.syn_pathways[postsyn_pop_idx, presyn_pop_idx].copy()
 
         if np.sum(layered_input) < 1e-9:
             # If this has happened the connection probability is non-zero,
@@ -447,69 +640,24 @@ class PotjansDiesmannKernels:
             # print(f"{presyn_pop} to {postsyn_pop}: {layered_input} " +
             #      "while connection probability is non-zero: " +
             #      f"{self.conn_probs[postsyn_pop_idx, presyn_pop_idx]}")
-            layered_input[postsyn_l_idx] = 1.0
-
-        # Parameters for a chosen representative post-synaptic cell model:
-        cell_params = dict(
-            morphology=os.path.join(morphology_folder,
-                                    self.morph_map[postsyn_pop]),
-            templatename='LFPyCellTemplate',
-            templatefile=os.path.join(template_folder, 'LFPyCellTemplate.hoc'),
-            v_init=self.E_L,
-            cm=1.0,
-            Ra=150,
-            passive=True,
-            passive_parameters=dict(g_pas=1. / (self.tau_m * 1E3),  # assume cm=1
-                                    e_pas=self.E_L),
-            nsegs_method='lambda_f',
-            lambda_f=100,
-            dt=self.dt,
-            delete_sections=True,
-            templateargs=None,
-        )
+            layered_input = self._eye_layers[postsyn_l_idx]
 
-        # Parameters for the postsynaptic population.
-        # For mathematical convenience, the spatial spread of the
-        # somas and synapses in the depth direction (z-axis) are treated
-        # as gaussians, with a standard deviation
-        # of layer_thickness/spatial_spread_dz. The spatial_spread_dz parameter
-        # is important in deciding the resulting LFP amplitude, with a larger
-        # value giving higher LFP amplitudes.
-        self.spatial_spread_dz = 4
-        population_area = 1000**2  # Potians Diesmann model has area of 1000 µm^2
-        population_params = dict(
-            radius=np.sqrt(population_area / np.pi),  # population radius
-            loc=self.layer_mids[postsyn_l_idx],  # population center along z-axis
-            scale=self.layer_thicknesses[postsyn_l_idx] / self.spatial_spread_dz)  # SD along z-axis
+        cell_params, population_params, gauss_cyl_potential = \
+            self._get_postsyn_setup(postsyn_pop)
 
         # See the documentation of LFPykernels for a better description of
         # these paramters:
         rotation_args = {'x': 0.0, 'y': 0.0}
         sections = "allsec" if "I" in presyn_pop else ["dend", "apic"]
         syn_pos_params = [dict(section=sections,
-                               fun=[st.norm] * len(self.layers),
-                               funargs=[dict(loc=self.layer_mids[l_idx],
-                                             scale=self.layer_thicknesses[l_idx] / self.spatial_spread_dz)
-                                        for l_idx in range(len(self.layers))],
+                               fun=self._layer_funs,
+                               funargs=self._layer_funargs,
                                funweights=layered_input
                                )]
 
-        gauss_cyl_potential = GaussCylinderPotential(
-            cell=None,
-            z=self.elec_params['z'],
-            sigma=self.elec_params['sigma'],
-            R=population_params['radius'],
-            sigma_z=population_params['scale'],
-        )
-
-        if presyn_pop == 'TC':
-            PSP_mean = self.stim_dict['PSP_th']
-            delay_mean = self.stim_dict['delay_th_mean']
-            delay_rel_std = self.stim_dict['delay_th_rel_std']
-        else:
-            PSP_mean = self.net_dict['PSP_matrix_mean'][postsyn_pop_idx, presyn_pop_idx]
-            delay_mean = self.net_dict['delay_matrix_mean'][postsyn_pop_idx, presyn_pop_idx]
-            delay_rel_std = self.net_dict['delay_rel_std']
+        PSP_mean = self.PSP_mean_full[postsyn_pop_idx, presyn_pop_idx]
+        delay_mean = self.delay_mean_full[postsyn_pop_idx, presyn_pop_idx]
+        delay_rel_std = self.delay_rel_std_full[presyn_pop_idx]
 
         C_YX = self.conn_probs[postsyn_pop_idx].copy()
         if self.net_dict['K_scaling'] != 1:
@@ -532,8 +680,8 @@ class PotjansDiesmannKernels:
         kernel = KernelApprox(
             X=[presyn_pop],
             Y=postsyn_pop,
-            N_X=np.array([self.pop_sizes[presyn_pop_idx]]),
-            N_Y=self.pop_sizes[postsyn_pop_idx],
+            N_X=np.array([self.pop_arr['size'][presyn_pop_idx]]),
+            N_Y=self.pop_arr['size'][postsyn_pop_idx],
             C_YX=C_YX,
             cellParameters=cell_params,
             rotationParameters=rotation_args,
@@ -556,108 +704,175 @@ class PotjansDiesmannKernels:
                                  Vrest=self.E_L, dt=self.dt, X=presyn_pop,
                                  t_X=self.t_X, tau=self.tau,
                                  g_eff=self.g_eff, fir=False)
-        k_ = H_XY['GaussCylinderPotential']
+        # The kernels are returned by class name of the probe:
+        k_ = H_XY[type(gauss_cyl_potential).__name__]
 
         # Save kernel to file for later use
         np.save(filename, k_)
 
         if self.plot_kernels:
-            t_k = np.arange(k_.shape[1]) * self.dt
-
-            cell = kernel.cell
-
-            plt.close("all")
-            fig = plt.figure(figsize=[16, 5])
-            fig.subplots_adjust(left=0.05, right=0.98, top=0.82, wspace=0.4)
-            fig.suptitle(f"LFP kernel for input to {postsyn_pop} from {presyn_pop}")
-            ax_m = fig.add_subplot(151, aspect=1, xlim=[-500, 500],
-                                   ylim=[-1600, 200],
-                                   title="postsynaptic neuron")
-            ax_s = fig.add_subplot(152, ylim=[-1600, 200],
-                                   title="synaptic input density\nBinzegger data")
-            ax_g = fig.add_subplot(153, ylim=[-1600, 200],
-                                   title="inferred gaussian input profile")
-            ax_w = fig.add_subplot(154, ylim=[-1600, 200],
-                                   title="per. comp synaptic weight")
-            ax_k = fig.add_subplot(155, ylim=[-1600, 200],
-                                   title="LFP kernel")
-
-            [ax_m.axhline(boundary[0], c='gray', ls='--')
-             for boundary in self.layer_boundaries.values()]
-            ax_m.axhline(self.layer_boundaries["6"][1], c='gray', ls='--')
-
-            ax_m.plot(cell.x.T, cell.z.T, c='k')
-
-            poss_idx = cell.get_idx(section="allsec", z_min=-1e9, z_max=1e9)
-            p = np.zeros_like(cell.area)
-            p[poss_idx] = cell.area[poss_idx]
-            mod = np.zeros(poss_idx.shape)
-
-            xs_ = [0]
-            ys_ = [0]
-            for l_idx, layer in enumerate(self.layers):
-                df = st.norm(loc=self.layer_mids[l_idx],
-                             scale=self.layer_thicknesses[l_idx] / 2)
-                # Normalize to have same area, regardless of layer thickhness
-                mod += df.pdf(x=cell.z[poss_idx].mean(axis=-1)
-                              ) * layered_input[l_idx]
-
-                xs_.extend([layered_input[l_idx] /
-                            self.layer_thicknesses[l_idx]] * 2)
-                ys_.extend(self.layer_boundaries[layer])
-
-            xs_.append(0)
-            ys_.append(self.layer_boundaries["6"][1])
-            ax_s.plot(xs_, ys_, c=self.pop_clrs[presyn_pop], label=presyn_pop)
-
-            ax_g.plot(mod, cell.z.mean(axis=1), '.',
-                      c=self.pop_clrs[presyn_pop])
+            self._plot_pathway_kernel(kernel, k_, postsyn_pop, presyn_pop,
+                                      layered_input)
+
+        # Delete the NEURON sections of the cell model right away, so that
+        # only one cell model is kept in memory at any time (get_kernel
+        # already released the reference held by the probe):
+        for sec in list(kernel.cell.allseclist):
+            h.delete_section(sec=sec)
+        del kernel
+        gc.collect()
+
+    def _plot_pathway_kernel(self, kernel, k_, postsyn_pop, presyn_pop,
+                             layered_input):
+        """
+        Plot the postsynaptic cell model, the synaptic input profile,
+        and the resulting LFP kernel of one connection pathway
+        """
+        t_k = np.arange(k_.shape[1]) * self.dt
+
+        cell = kernel.cell
+
+        plt.close("all")
+        fig = plt.figure(figsize=[16, 5])
+        fig.subplots_adjust(left=0.05, right=0.98, top=0.82, wspace=0.4)
+        fig.suptitle(f"LFP kernel for input to {postsyn_pop} from {presyn_pop}")
+        ax_m = fig.add_subplot(151, aspect=1, xlim=[-500, 500],
+                               ylim=[-1600, 200],
+                               title="postsynaptic neuron")
+        ax_s = fig.add_subplot(152, ylim=[-1600, 200],
+                               title="synaptic input density\nBinzegger data")
+        ax_g = fig.add_subplot(153, ylim=[-1600, 200],
+                               title="inferred gaussian input profile")
+        ax_w = fig.add_subplot(154, ylim=[-1600, 200],
+                               title="per. comp synaptic weight")
+        ax_k = fig.add_subplot(155, ylim=[-1600, 200],
+                               title="LFP kernel")
+
+        [ax_m.axhline(boundary[0], c='gray', ls='--')
+         for boundary in self.layer_boundaries.values()]
+        ax_m.axhline(self.layer_boundaries["6"][1], c='gray', ls='--')
+
+        ax_m.plot(cell.x.T, cell.z.T, c='k')
+
+        poss_idx = cell.get_idx(section="allsec", z_min=-1e9, z_max=1e9)
+        p = np.zeros_like(cell.area)
+        p[poss_idx] = cell.area[poss_idx]
+        layer_mids = np.array(self.layer_mids)
+        layer_thicknesses = np.array(self.layer_thicknesses)
+        # Gaussian input profile of each layer, evaluated for all
+        # compartments at once, normalized to have same area, regardless
+        # of layer thickness:
+        z_mean = cell.z[poss_idx].mean(axis=-1)
+        pdfs = st.norm.pdf(z_mean[:, None], loc=layer_mids[None, :],
+                           scale=layer_thicknesses[None, :] / 2)
+        mod = pdfs @ layered_input
+
+        xs_ = np.r_[0, np.repeat(layered_input / layer_thicknesses, 2), 0]
+        ys_ = np.r_[0, np.ravel([self.layer_boundaries[layer]
+                                 for layer in self.layers]),
+                    self.layer_boundaries["6"][1]]
+        ax_s.plot(xs_, ys_, c=self.pop_clrs[presyn_pop], label=presyn_pop)
+
+        ax_g.plot(mod, cell.z.mean(axis=1), '.',
+                  c=self.pop_clrs[presyn_pop])
+
+        ax_w.plot(kernel.comp_weight, cell.z.mean(axis=1), 'k.')
+
+        k_norm = np.max(np.abs(k_))
 
-            ax_w.plot(kernel.comp_weight, cell.z.mean(axis=1), 'k.')
+        for elec_idx in range(self.num_elecs):
+            ax_k.plot(t_k, k_[elec_idx] / k_norm * self.dz +
+                      self.elec_params["z"][elec_idx],
+                      c='k')
 
-            k_norm = np.max(np.abs(k_))
+        ax_k.plot([30, 30], [-1000, -1000 + self.dz], c='gray', lw=1.5)
+        ax_k.text(31, -1000 + self.dz / 2, f"{k_norm * 1000: 1.2f} µV",
+                  color="gray")
 
-            for elec_idx in range(self.num_elecs):
-                ax_k.plot(t_k, k_[elec_idx] / k_norm * self.dz +
-                          self.elec_params["z"][elec_idx],
-                          c='k')
+        fig.legend(frameon=False, ncol=6, loc=(0.3, 0.75))
+        plt.savefig(os.path.join(self.fig_folder,
+                                 f"fig_pathways_syn_input_"
+                                 f"{postsyn_pop}_{presyn_pop}.png"))
 
-            ax_k.plot([30, 30], [-1000, -1000 + self.dz], c='gray', lw=1.5)
-            ax_k.text(31, -1000 + self.dz / 2, f"{k_norm * 1000: 1.2f} µV",
-                      color="gray")
+    def _existing_kernel_files(self):
+        """
+        Returns the set of file names in the simulation folder, so the
+        existence of many kernel files can be checked with a single
+        directory listing
+        """
+        return set(os.listdir(self.sim_saveforlder))
 
-            fig.legend(frameon=False, ncol=6, loc=(0.3, 0.75))
-            plt.savefig(os.path.join(self.fig_folder,
-                                     f"fig_pathways_syn_input_"
-                                     f"{postsyn_pop}_{presyn_pop}.png"))
+    def _pathway_kernel_needed(self, postsyn_pop, presyn_pop, existing_files):
+        """
+        Check if the LFP kernel of an existing connection pathway must be
+        calculated, that is, if the kernel is not already on disc
+        (unless self.overwrite_kernels is True).
+        """
+        f_name = os.path.basename(self._kernel_files[(postsyn_pop, presyn_pop)])
+        return self.overwrite_kernels or f_name not in existing_files
 
     def _calculate_all_pathway_kernels(self):
         """
         Calculate all pathway kernels using MPI. If a kernel already
         exist on disc, they are not recalculated unless
         self.overwrite_kernels is True.
+
+        The cost of each pathway varies a lot, so pathways are handed out
+        dynamically: rank 0 acts as master and sends a new pathway to
+        each worker rank as soon as it asks for one.
         """
-        task_idx = 0
-        # Loop through all synaptic pathways in the model and calculate kernels:
-        for postsyn_pop_idx, postsyn_pop in enumerate(self.postsyn_pops):
-            for presyn_pop_idx, presyn_pop in enumerate(self.presyn_pops):
-                if task_idx % size == rank:
-                    print(f"{presyn_pop} to {postsyn_pop} on rank {rank}")
-                    self._calculate_one_pathway_kernel(postsyn_pop, presyn_pop)
-                task_idx += 1
+        if rank == 0:
+            # All existing synaptic pathways in the model that need a kernel:
+            existing_files = self._existing_kernel_files()
+            tasks = [(postsyn_pop, presyn_pop)
+                     for postsyn_pop, presyn_pop in self._pathway_tasks
+                     if self._pathway_kernel_needed(postsyn_pop, presyn_pop,
+                                                    existing_files)]
+        else:
+            tasks = None
+        # All ranks must know whether there is any work, since the
+        # morphologies are only needed (and prefetched) in that case:
+        have_tasks = comm.bcast(tasks is not None and len(tasks) > 0, root=0)
+        if not have_tasks:
+            return
+        self._prefetch_morphologies()
+
+        if size == 1:
+            for postsyn_pop, presyn_pop in tasks:
+                print(f"{presyn_pop} to {postsyn_pop} on rank {rank}")
+                self._calculate_one_pathway_kernel(postsyn_pop, presyn_pop)
+        elif rank == 0:
+            num_finished_workers = 0
+            while num_finished_workers < size - 1:
+                status = MPI.Status()
+                comm.recv(source=MPI.ANY_SOURCE, tag=TAG_REQUEST,
+                          status=status)
+                task = tasks.pop(0) if len(tasks) > 0 else None
+                if task is None:
+                    num_finished_workers += 1
+                comm.send(task, dest=status.Get_source(), tag=TAG_WORK)
+        else:
+            while True:
+                comm.send(None, dest=0, tag=TAG_REQUEST)
+                task = comm.recv(source=0, tag=TAG_WORK)
+                if task is None:
+                    break
+                postsyn_pop, presyn_pop = task
+                print(f"{presyn_pop} to {postsyn_pop} on rank {rank}")
+                self._calculate_one_pathway_kernel(postsyn_pop, presyn_pop)
 
     def _load_pathway_kernels(self):
         """
-        Loads the LFP kernels from each connection pathway from file
+        Loads the LFP kernels from each connection pathway from file.
+        The files are memory-mapped, so the data is only read when the
+        kernels are summed in _find_kernels.
         """
+        # Pathway kernels are keyed by (postsyn_pop, presyn_pop):
         self.H = {}
-        for postsyn_pop_idx, postsyn_pop in enumerate(self.postsyn_pops):
-            for presyn_pop_idx, presyn_pop in enumerate(self.presyn_pops):
-                pathway_name = f'{postsyn_pop}:{presyn_pop}'
-                f_name = os.path.join(self.sim_saveforlder,
-                                      f'kernel_{pathway_name}.npy')
-                if os.path.isfile(f_name):
-                    self.H[pathway_name] = np.load(f_name)
+        existing_files = self._existing_kernel_files()
+        for pathway, f_name in self._kernel_files.items():
+            if os.path.basename(f_name) in existing_files:
+                self.H[pathway] = np.load(f_name, mmap_mode='r')
 
     def _find_kernels(self):
         """
@@ -666,14 +881,105 @@ class PotjansDiesmannKernels:
         the corresponding summed LFP kernel.
         """
 
-        self.pop_kernels = {}
-        for pop_idx, pop_name in enumerate(self.presyn_pops):
-            self.pop_kernels[pop_name] = np.zeros((self.num_elecs,
-                                                   self.kernel_length))
-            for pathway_name in self.H.keys():
-                if pathway_name.endswith(pop_name):
-                    if self.H[pathway_name] is not None:
-                        self.pop_kernels[pop_name] += self.H[pathway_name]
+        # Population kernels with shape
+        # (num_presyn_pops, num_elecs, kernel_length):
+        self.pop_kernels_arr = np.zeros((len(self.presyn_pops),
+                                         self.num_elecs, self.kernel_length),
+                                        dtype=self.lfp_dtype)
+        for (postsyn_pop, presyn_pop), H_YX in self.H.items():
+            self.pop_kernels_arr[self.presyn_pop_idx[presyn_pop]] += H_YX
+        # The pathway kernels are no longer needed, release the file maps:
+        del self.H
+        # The Fourier transform of the kernels is precomputed, see
+        # _prepare_kernel_fft, so the kernels are read-only, and must
+        # be changed through set_pop_kernel. pop_kernels gives (read-only)
+        # views of the kernel of each population:
+        self.pop_kernels_arr.flags.writeable = False
+        self.pop_kernels = {pop_name: self.pop_kernels_arr[pop_idx]
+                            for pop_idx, pop_name in enumerate(self.presyn_pops)}
+
+    def _prepare_kernel_fft(self):
+        """
+        Precompute the Fourier transform of the population kernels, for
+        overlap-add convolution with firing rates split in blocks of
+        length self._block_len.
+        """
+        self._nfft = next_fast_len(2 * self.kernel_length - 1, real=True)
+        # Each block overlaps only with the next one:
+        self._block_len = self._nfft - self.kernel_length + 1
+        # scipy.fft and cupy.fft keep single precision, giving complex64
+        # spectra:
+        self._pop_kernels_fft = self._rfft(self.xp.asarray(self.pop_kernels_arr),
+                                           n=self._nfft, axis=-1)
+
+    def set_pop_kernel(self, pop_name, kernel):
+        """
+        Replace the LFP kernel of a presynaptic population, and update
+        its precomputed Fourier transform.
+
+        Parameters
+        ---------
+        pop_name: str
+            name of presynaptic population
+        kernel: ndarray
+            LFP kernel with shape (num_elecs, kernel_length)
+        """
+        pop_idx = self.presyn_pop_idx[pop_name]
+        self.pop_kernels_arr.flags.writeable = True
+        self.pop_kernels_arr[pop_idx] = kernel
+        self.pop_kernels_arr.flags.writeable = False
+        self._pop_kernels_fft[pop_idx] = self._rfft(
+            self.xp.asarray(self.pop_kernels_arr[pop_idx]),
+            n=self._nfft, axis=-1)
+
+    def _convolve_with_kernels(self, pop_idxs, fr_):
+        """
+        Full convolution of the firing rates fr_, with shape
+        (len(pop_idxs), num_timesteps), with the kernels of the
+        corresponding populations, summed over populations.
+        Returns array with shape
+        (num_elecs, num_timesteps + kernel_length - 1),
+        on the GPU if self.use_gpu
+        """
+        xp = self.xp
+        num_pops, num_tsteps = fr_.shape
+        block_len = self._block_len
+        num_blocks = -(-num_tsteps // block_len)
+        out_len = num_tsteps + self.kernel_length - 1
+
+        fr_blocks = xp.zeros((num_pops, num_blocks * block_len),
+                             dtype=fr_.dtype)
+        fr_blocks[:, :num_tsteps] = xp.asarray(fr_)
+        fr_fft = self._rfft(fr_blocks.reshape(num_pops, num_blocks, block_len),
+                            n=self._nfft, axis=-1)
+        lfp_fft = xp.einsum('pef,pbf->ebf',
+                            self._pop_kernels_fft[xp.asarray(pop_idxs)],
+                            fr_fft)
+        lfp_blocks = self._irfft(lfp_fft, n=self._nfft, axis=-1)
+
+        # Overlap-add the blocks, where the tail of each block
+        # (kernel_length - 1 long) is added to the start of the next
+        lfp_ = xp.zeros((self.num_elecs, (num_blocks + 1) * block_len),
+                        dtype=lfp_blocks.dtype)
+        lfp_[:, :num_blocks * block_len] = lfp_blocks[:, :, :block_len].reshape(
+            self.num_elecs, -1)
+        lfp_[:, block_len:].reshape(self.num_elecs, num_blocks, block_len)[
+            :, :, :self.kernel_length - 1] += lfp_blocks[:, :, block_len:]
+        return lfp_[:, :out_len]
+
+    def firing_rate(self, pop_name):
+        """
+        Returns the firing rate of the given presynaptic population
+        """
+        return self.fr[self.presyn_pop_idx[pop_name]]
+
+    def _to_host(self, arr):
+        """
+        Returns arr as a numpy array, copied from the GPU if self.use_gpu
+        """
+        if self.use_gpu:
+            return cupy.asnumpy(arr)
+        return arr
 
     def _load_firing_rates_from_file(self):
         """
@@ -691,14 +997,14 @@ class PotjansDiesmannKernels:
 
         self.bins = np.arange(sim_start, sim_end, self.dt)
 
-        with open(os.path.join(self.firing_rate_path,
-                               'population_nodeids.dat')) as f:
-            self.gid_data = np.array([l_.split() for l_ in f.readlines()],
-                                     dtype=int)
-            for pop_idx, pop_name in enumerate(self.presyn_pops):
-                # TC population is not in gid_data if not modelled
-                if pop_idx < self.gid_data.shape[0]:
-                    self.pop_gids[pop_name] = self.gid_data[pop_idx]
+        self.gid_data = np.loadtxt(os.path.join(self.firing_rate_path,
+                                                'population_nodeids.dat'),
+                                   dtype=np.int64, ndmin=2)
+        # TC population is not in gid_data if not modelled
+        for pop_idx, pop_name in enumerate(
+                self.presyn_pops[:self.gid_data.shape[0]]):
+            self.pop_gids[pop_name] = self.gid_data[pop_idx]
+        self._set_pop_gid_lookup()
 
         pop_spike_times, self.firing_rates = self._load_and_return_spikes()
 
@@ -715,10 +1021,32 @@ class PotjansDiesmannKernels:
             fig.legend(ncol=8, frameon=False)
             plt.savefig(os.path.join(self.fig_folder, "pop_firing_rates.png"))
 
+    def _set_pop_gid_lookup(self):
+        """
+        Set up sorted arrays of the first and last gid of each population
+        in self.pop_gids, for fast lookup of population from gid
+        """
+        self._pop_name_list = sorted(self.pop_gids,
+                                     key=lambda pop_name: self.pop_gids[pop_name][0])
+        self._pop_starts = np.array([self.pop_gids[pop_name][0]
+                                     for pop_name in self._pop_name_list])
+        self._pop_ends = np.array([self.pop_gids[pop_name][1]
+                                   for pop_name in self._pop_name_list])
+
+    def _return_pop_names_from_gids(self, gids):
+        """
+        Returns the index in self._pop_name_list of the population of
+        each gid in the array gids, or -1 for gids outside all populations
+        """
+        gids = np.asarray(gids)
+        idx = np.searchsorted(self._pop_starts, gids, side='right') - 1
+        valid = (idx >= 0) & (gids <= self._pop_ends[np.maximum(idx, 0)])
+        return np.where(valid, idx, -1)
+
     def _return_pop_name_from_gid(self, gid):
-        for pop_name in self.presyn_pops:
-            if self.pop_gids[pop_name][0] <= gid <= self.pop_gids[pop_name][1]:
-                return pop_name
+        idx = self._return_pop_names_from_gids(gid)
+        if idx >= 0:
+            return self._pop_name_list[idx]
 
     def _load_and_return_spikes(self):
         """
@@ -732,114 +1060,118 @@ class PotjansDiesmannKernels:
         fr_files = [f for f in os.listdir(self.firing_rate_path)
                     if f.startswith('spike_recorder-')]
         for f_ in fr_files:
-            with open(os.path.join(self.firing_rate_path, f_)) as f:
-                d_ = [d__.split('\t') for d__ in f.readlines()[3:]]
-
-                gids, times = np.array(d_, dtype=float).T
-                for pop_idx, pop_name in enumerate(self.presyn_pops):
-                    if pop_idx < self.gid_data.shape[0]:
-                        p_spikes_mask = (self.pop_gids[pop_name][0] <= gids) & \
-                                        (gids <= self.pop_gids[pop_name][1])
-                        pop_spike_times[pop_name].extend(times[p_spikes_mask])
+            # Skip the three header lines, columns are sender (gid) and time:
+            gids, times = np.loadtxt(os.path.join(self.firing_rate_path, f_),
+                                     skiprows=3, usecols=(0, 1), ndmin=2).T
+            # Population of each spike, found in one pass, and the spikes
+            # grouped by population with a stable sort:
+            pop_idxs = self._return_pop_names_from_gids(gids)
+            valid = pop_idxs >= 0
+            pop_idxs, times = pop_idxs[valid], times[valid]
+            order = np.argsort(pop_idxs, kind='stable')
+            counts = np.bincount(pop_idxs, minlength=len(self._pop_name_list))
+            groups = np.split(times[order], np.cumsum(counts)[:-1])
+            for pop_name, pop_times in zip(self._pop_name_list, groups):
+                pop_spike_times[pop_name].extend(pop_times)
 
         for pop_idx, pop_name in enumerate(self.presyn_pops):
-            pop_spike_times[pop_name] = np.sort(pop_spike_times[pop_name])
+            pop_spike_times[pop_name] = np.array(pop_spike_times[pop_name])
             fr__, _ = np.histogram(pop_spike_times[pop_name], bins=self.bins)
             firing_rates[pop_name] = fr__
 
         return pop_spike_times, firing_rates
 
-    def plot_final_results(self, fig_name='summary_LFP'):
+    def _plot_fr_and_lfp(self, xlim, lfp_traces):
         """
-        Plot final results after simulation end, with both the firing rate
-        of each individual population and the resulting LFP.
+        Plot the firing rate of each individual population, and
+        one or more LFP traces. The same figure is reused for every call,
+        with the axes cleared, and is returned for saving.
+
+        Parameters
+        ---------
+        xlim: list
+            time limits of plot (ms)
+        lfp_traces: list of (ndarray, str)
+            LFP with shape (num_elecs, len(tvec)), and color of traces.
+            All traces are normalized by the maximum of the first trace
         """
-        plt.close('all')
-        fig = plt.figure(figsize=[8, 8])
-        fig.subplots_adjust(right=0.85, hspace=0.5)
-        xlim = [np.max([0, self.tvec[-1] - 400]), self.tvec[-1]]
-        ax_fr = fig.add_subplot(211, title="firing rates", xlabel="time (ms)",
-                                 xlim=xlim)
+        if self._diag_fig is None:
+            self._diag_fig = plt.figure(figsize=[8, 8])
+            self._diag_fig.subplots_adjust(right=0.85, hspace=0.5)
+            self._ax_fr, self._ax_lfp = self._diag_fig.subplots(2, 1)
+        else:
+            self._ax_fr.cla()
+            self._ax_lfp.cla()
+        fig, ax_fr, ax_lfp = self._diag_fig, self._ax_fr, self._ax_lfp
+
+        ax_fr.set(title="firing rates", xlabel="time (ms)", xlim=xlim)
 
-        max_fr = np.max([np.max(np.abs(fr_)) for fr_ in self.fr_dict.values()])
+        max_fr = np.max(np.abs(self.fr))
 
         for p_idx, pop in enumerate(self.presyn_pops):
             ax_fr.plot(self.tvec, self.fr_dict[pop] / max_fr + p_idx, label=pop)
         ax_fr.legend(frameon=False, loc=(1.0, 0.45))
 
-        ax_lfp = fig.add_subplot(212, title="LFP", xlabel="time (ms)",
-                                 ylabel="depth (µm)",
-                                 ylim=[-1600, 200], xlim=xlim)
+        ax_lfp.set(title="LFP", xlabel="time (ms)", ylabel="depth (µm)",
+                   ylim=[-1600, 200], xlim=xlim)
 
-        lfp_norm = np.max(np.abs(self.lfp))
-        for elec_idx in range(self.num_elecs):
-            ax_lfp.plot(self.tvec, self.lfp[elec_idx] / lfp_norm * self.dz +
-                        self.elec_params["z"][elec_idx], c='k')
+        lfp_norm = np.max(np.abs(lfp_traces[0][0]))
+        # All electrodes of one trace are drawn as a single LineCollection
+        tvecs = np.broadcast_to(self.tvec, (self.num_elecs, len(self.tvec)))
+        for lfp, clr in lfp_traces:
+            ys = lfp / lfp_norm * self.dz + self.elec_params["z"][:, None]
+            ax_lfp.add_collection(LineCollection(np.stack([tvecs, ys], axis=-1),
+                                                 colors=clr))
 
         ax_lfp.plot([xlim[1], xlim[1]], [-100, -100 + self.dz], c='gray',
                     lw=1.5, clip_on=False)
         ax_lfp.text(xlim[1], -100 + self.dz / 2, f"{lfp_norm * 1000: 1.2f} µV",
                     color="gray", ha='left', va='center')
         simplify_axes(fig.axes)
-        fig.savefig(os.path.join(self.fig_folder, f"{fig_name}.png"))
+        return fig
 
-    # def update_lfp_DEPRECATED(self, lfp, t_idx, firing_rate):
-    #     """
-    #     Calculate LFP resulting from LFP kernel, given a
-    #     firing rate at a given time index.
-    #
-    #     This method is DEPRECATED, and only exist for reference.
-    #     """
-    #     # For every new timestep the predicted LFP signal is made
-    #     # one timestep longer
-    #
-    #     # self.lfp.append([0] * self.num_elecs)
-    #     if lfp is None:
-    #         lfp = np.zeros((self.num_elecs, self.kernel_length - 1))
-    #
-    #     lfp = np.append(lfp, np.zeros((self.num_elecs, 1)), axis=1)
-    #     # Find the time indexes where the LFP is calculated:
-    #     window_idx0 = t_idx - int(self.kernel_length / 2)
-    #     window_idx1 = t_idx + int(self.kernel_length / 2)
-    #     sig_idx0 = 0 if window_idx0 < 0 else window_idx0
-    #     sig_idx1 = window_idx1
-    #     k_idx0 = -window_idx0 if window_idx0 < 0 else 0
-    #
-    #     # This is essentially a manual convolution, one timestep at the time,
-    #     # between the firingrate and the kernel
-    #     for p_idx, pop in enumerate(self.presyn_pops):
-    #         for elec_idx in range(self.num_elecs):
-    #             lfp_ = firing_rate[pop] * self.pop_kernels[pop][elec_idx][k_idx0:]
-    #             lfp[elec_idx, sig_idx0:sig_idx1] += lfp_
-    #     return lfp
-
-    # def get_firingrate_from_buffer(self, buffer, fr_dict):
-    #     """ Get firing rate from buffer.  """
-    #
-    #     for pop_ID in set(buffer[:, 0]):
-    #         if int(pop_ID) not in fr_dict.keys():
-    #             fr_dict[int(pop_ID)] = np.zeros(len(self.tvec))
-    #         times = buffer[buffer[:, 0] == pop_ID][:, 2]
-    #         # assert times[-1] <= self.tvec[-1], "spiketime after simulation end"
-    #
-    #         # Ignore spiketimes that comes after the last time step.
-    #         # times = times[times <= self.tvec[-1]]
-    #
-    #         for t_ in times:
-    #             if t_ > self.tvec[-1]:
-    #                 break
-    #             spiketime_idx = np.argmin(np.abs(t_ - self.tvec))
-    #             fr_dict[int(pop_ID)][spiketime_idx] += 1
-    #     return fr_dict
+    def plot_final_results(self, fig_name='summary_LFP'):
+        """
+        Plot final results after simulation end, with both the firing rate
+        of each individual population and the resulting LFP.
+        """
+        xlim = [np.max([0, self.tvec[-1] - 400]), self.tvec[-1]]
+        fig = self._plot_fr_and_lfp(xlim, [(self._to_host(self.lfp), 'k')])
+        fig.savefig(os.path.join(self.fig_folder, f"{fig_name}.png"))
 
     def save_final_results(self):
         """
         Save firing rate and LFP to file after simulation end.
+        Note that the arrays are saved with dtype self.lfp_dtype.
+        The files can be read back with load_final_results.
+        """
+        np.savez_compressed(os.path.join(self.sim_saveforlder,
+                                         'firing_rate.npz'),
+                            fr=self.fr, pops=np.array(self.presyn_pops))
+        np.savez_compressed(os.path.join(self.sim_saveforlder, 'lfp.npz'),
+                            lfp=self._to_host(self.lfp))
+
+    @classmethod
+    def load_final_results(cls, sim_saveforlder):
         """
-        np.save(os.path.join(self.sim_saveforlder, 'firing_rate.npy'),
-                             self.fr_dict)
-        np.save(os.path.join(self.sim_saveforlder, 'lfp.npy'),
-                             self.lfp)
+        Load firing rate and LFP saved by save_final_results.
+
+        Returns
+        -------
+        fr_dict: dict
+            firing rate of each presynaptic population, as views of
+            the stacked firing rate array
+        lfp: ndarray
+            LFP with shape (num_elecs, num_timesteps)
+        """
+        with np.load(os.path.join(sim_saveforlder, 'firing_rate.npz')) as f:
+            fr = f['fr']
+            pops = f['pops']
+        fr_dict = {str(pop_name): fr[pop_idx]
+                   for pop_idx, pop_name in enumerate(pops)}
+        with np.load(os.path.join(sim_saveforlder, 'lfp.npz')) as f:
+            lfp = f['lfp']
+        return fr_dict, lfp
 
     def update(self, buffer):
         """
@@ -860,74 +1192,92 @@ class PotjansDiesmannKernels:
         # Find smallest and largest time in buffer, so we can
         # update the corresponding part of the LFP signal
         t0, t1 = np.min(buffer[:, 2]), np.max(buffer[:, 2])
-        t0_idx = np.argmin(np.abs(t0 - self.tvec))
-        t1_idx = np.argmin(np.abs(t1 - self.tvec)) + 1
-
-        for pop_ID in set(buffer[:, 0]):
-            pop_name = self.pop_IDs[pop_ID]
-            spiketimes = buffer[buffer[:, 0] == pop_ID][:, 2]
+        # Closest time index on the uniform grid self.tvec:
+        last_idx = len(self.tvec) - 1
+        t0_idx = min(max(0, int(np.rint((t0 - self.tvec[0]) / self.dt))), last_idx)
+        t1_idx = min(max(0, int(np.rint((t1 - self.tvec[0]) / self.dt))), last_idx) + 1
+
+        # Group the spike events by spike recorder ID with a single sort,
+        # instead of masking the full buffer for each population:
+        buffer = buffer[np.argsort(buffer[:, 0], kind='stable')]
+        pop_IDs, starts = np.unique(buffer[:, 0], return_index=True)
+        ends = np.r_[starts[1:], len(buffer)]
+
+        pop_idxs = []
+        for pop_ID, start, end in zip(pop_IDs, starts, ends):
+            pop_idx = self.presyn_pop_idx[self.pop_IDs[pop_ID]]
+            spiketimes = buffer[start:end, 2]
+
+            # Ignore spiketimes that comes after the last time step.
+            spiketimes = spiketimes[spiketimes <= self.tvec[-1]]
+            # tvec is a uniform grid, so the closest time index of each spike
+            # is found directly:
+            spiketime_idx = np.rint((spiketimes - self.tvec[0]) /
+                                    self.dt).astype(np.intp)
+            spiketime_idx = spiketime_idx[spiketime_idx >= 0]
+            np.add.at(self.fr[pop_idx], spiketime_idx, 1)
+            pop_idxs.append(pop_idx)
+
+        # The LFP contribution from all populations in the buffer is
+        # found in one go:
+        fr_ = self.fr[pop_idxs, t0_idx:t1_idx]
+        window_idx0 = t0_idx #- int(self.kernel_length / 2)
+        window_idx1 = t1_idx + int(self.kernel_length / 2) - 1
+        sig_idx0 = max(0, window_idx0)
+        # No need to clip at the last time step, thanks to the padding
+        # of self._lfp_buffer:
+        sig_idx1 = window_idx1
+        # First index of the full convolution that goes into the LFP:
+        k_start = int(self.kernel_length / 2) + (sig_idx0 - window_idx0)
+
+        if HAVE_NUMBA and not self.use_gpu and fr_.shape[1] < self.kernel_length:
+            # Short firing rates are mostly zero, and the kernels are added
+            # directly for each non-zero time step
+            _accumulate_lfp(np.ascontiguousarray(self.pop_kernels_arr[pop_idxs]),
+                            np.ascontiguousarray(fr_),
+                            self._lfp_buffer[:, sig_idx0:sig_idx1], k_start)
+            return
 
-            for t_ in spiketimes:
-                if t_ > self.tvec[-1]:
-                    # Ignore spiketimes that comes after the last time step.
-                    break
-                spiketime_idx = np.argmin(np.abs(t_ - self.tvec))
-                self.fr_dict[pop_name][spiketime_idx] += 1
-
-            fr_ = self.fr_dict[pop_name][t0_idx:t1_idx]
-            window_idx0 = t0_idx #- int(self.kernel_length / 2)
-            window_idx1 = t1_idx + int(self.kernel_length / 2) - 1
-            sig_idx0 = 0 if window_idx0 < 0 else window_idx0
-            sig_idx1 = window_idx1 if window_idx1 < len(self.tvec) else len(self.tvec)
-
-            for elec_idx in range(self.num_elecs):
-                k_ = self.pop_kernels[pop_name][elec_idx, :]
-                lfp_ = np.convolve(k_, fr_, mode='full')[int(self.kernel_length / 2):]
-                if len(self.lfp[elec_idx, sig_idx0:sig_idx1]) == len(lfp_):
-                    self.lfp[elec_idx, sig_idx0:sig_idx1] += lfp_
-                else:
-                    self.lfp[elec_idx, sig_idx0:sig_idx1] += lfp_[:(sig_idx1 - sig_idx0)]
+        lfp_ = self._convolve_with_kernels(pop_idxs, fr_)[:, k_start:]
+        self._lfp_buffer[:, sig_idx0:sig_idx1] += lfp_
 
     def sanity_test_convolution(self):
-        lfp_postcalc = np.zeros((self.num_elecs, len(self.tvec)))
-        for pop_idx, pop_name in enumerate(self.presyn_pops):
-            fr_ = self.fr_dict[pop_name]
-            for elec_idx in range(self.num_elecs):
-                k_ = self.pop_kernels[pop_name][elec_idx, :]
-                lfp_ = np.convolve(k_, fr_, mode='full')[int(self.kernel_length / 2):]
-                lfp_postcalc[elec_idx, :] += lfp_[:len(lfp_postcalc[elec_idx, :])]
-        print(np.max(np.abs(self.lfp - lfp_postcalc)))
-
-        plt.close('all')
-        fig = plt.figure(figsize=[8, 8])
-        fig.subplots_adjust(right=0.85, hspace=0.5)
+        lfp_postcalc = np.zeros((self.num_elecs, len(self.tvec)),
+                                dtype=self.lfp_dtype)
+        all_pop_idxs = np.arange(len(self.presyn_pops))
+        lfp_ = self._convolve_with_kernels(all_pop_idxs, self.fr)[
+            :, int(self.kernel_length / 2):]
+        lfp_postcalc += self._to_host(lfp_[:, :lfp_postcalc.shape[1]])
+        lfp = self._to_host(self.lfp)
+        print(np.max(np.abs(lfp - lfp_postcalc)))
+
         xlim = [0, 1000]
-        ax_fr = fig.add_subplot(211, title="firing rates", xlabel="time (ms)",
-                                 xlim=xlim)
+        fig = self._plot_fr_and_lfp(xlim, [(lfp, 'k'), (lfp_postcalc, 'r')])
+        fig.savefig(os.path.join(self.fig_folder, f"sanity_test.png"))
 
-        max_fr = np.max([np.max(np.abs(fr_)) for fr_ in self.fr_dict.values()])
 
-        for p_idx, pop in enumerate(self.presyn_pops):
-            ax_fr.plot(self.tvec, self.fr_dict[pop] / max_fr + p_idx, label=pop)
-        ax_fr.legend(frameon=False, loc=(1.0, 0.45))
+class CachedGaussCylinderPotential(GaussCylinderPotential):
+    """
+    GaussCylinderPotential that reuses its transformation matrix.
 
-        ax_lfp = fig.add_subplot(212, title="LFP", xlabel="time (ms)",
-                                 ylabel="depth (µm)",
-                                 ylim=[-1600, 200], xlim=xlim)
+    The transformation matrix requires a numerical integral for every
+    pair of electrode and cell segment, but only depends on the positions
+    of the segments. KernelApprox.get_kernel creates a new, but identical,
+    cell model for every presynaptic population, so the matrix is only
+    recalculated if the segment positions differ from the previous call.
+    """
 
-        lfp_norm = np.max(np.abs(self.lfp))
-        for elec_idx in range(self.num_elecs):
-            ax_lfp.plot(self.tvec, self.lfp[elec_idx] / lfp_norm * self.dz +
-                        self.elec_params["z"][elec_idx], c='k')
-            ax_lfp.plot(self.tvec, lfp_postcalc[elec_idx] / lfp_norm * self.dz +
-                        self.elec_params["z"][elec_idx], c='r')
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._seg_z = None
+        self._M = None
 
-        ax_lfp.plot([xlim[1], xlim[1]], [-100, -100 + self.dz], c='gray',
-                    lw=1.5, clip_on=False)
-        ax_lfp.text(xlim[1], -100 + self.dz / 2, f"{lfp_norm * 1000: 1.2f} µV",
-                    color="gray", ha='left', va='center')
-        simplify_axes(fig.axes)
-        fig.savefig(os.path.join(self.fig_folder, f"sanity_test.png"))
+    def get_transformation_matrix(self):
+        seg_z = self.cell.z.mean(axis=-1)
+        if self._M is None or not np.array_equal(seg_z, self._seg_z):
+            self._M = super().get_transformation_matrix()
+            self._seg_z = seg_z
+        return self._M
 
 
 def simplify_axes(axes):
@@ -946,6 +1296,48 @@ def simplify_axes(axes):
         ax.get_yaxis().tick_left()
 
 
+def aligned_zeros(shape, dtype=np.float64, alignment=64):
+    """
+    Returns a C-contiguous array of zeros, where the first element is
+    aligned to the given number of bytes (default: a 64 byte cache line)
+    """
+    dtype = np.dtype(dtype)
+    num_bytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.zeros(num_bytes + alignment, dtype=np.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + num_bytes].view(dtype).reshape(shape)
+
+
+if HAVE_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _accumulate_lfp(kernels, fr, lfp, k_start):
+        """
+        Adds the full convolution of the firing rates fr, with shape
+        (num_pops, num_timesteps), with the kernels, with shape
+        (num_pops, num_elecs, kernel_length), summed over populations,
+        to lfp, with shape (num_elecs, num_out). Index j of lfp
+        corresponds to index j + k_start of the full convolution.
+        """
+        num_pops, num_elecs, kernel_length = kernels.shape
+        num_t = fr.shape[1]
+        num_out = lfp.shape[1]
+        for e in prange(num_elecs):
+            lfp_e = lfp[e]
+            for p in range(num_pops):
+                # Kernel of this population and electrode, fetched once
+                # for all time steps:
+                kernel_pe = kernels[p, e]
+                for t in range(num_t):
+                    fr_pt = fr[p, t]
+                    if fr_pt == 0:
+                        continue
+                    tau0 = max(0, k_start - t)
+                    tau1 = min(kernel_length, num_out + k_start - t)
+                    offset = t - k_start
+                    for tau in range(tau0, tau1):
+                        lfp_e[tau + offset] += fr_pt * kernel_pe[tau]
+
+
 if __name__ == '__main__':
 
     # This is for debugging purposes. Original data is overwritten by
@@ -957,11 +1349,10 @@ if __name__ == '__main__':
 
     spike_recorder_ids = np.arange(7718, 7726)
     PD_kernels = PotjansDiesmannKernels(spike_recorder_ids)
-    PD_kernels.pop_kernels[PD_kernels.pop_IDs[7719.]] *= 0
-    PD_kernels.pop_kernels[PD_kernels.pop_IDs[7719.]][:, int(PD_kernels.kernel_length/2) + 1] = 1e-5
-
-    PD_kernels.pop_kernels[PD_kernels.pop_IDs[7722.]] *= 0
-    PD_kernels.pop_kernels[PD_kernels.pop_IDs[7722.]][:, int(PD_kernels.kernel_length/2) + 1] = 1e-5
+    dummy_kernel = np.zeros((PD_kernels.num_elecs, PD_kernels.kernel_length))
+    dummy_kernel[:, int(PD_kernels.kernel_length/2) + 1] = 1e-5
+    PD_kernels.set_pop_kernel(PD_kernels.pop_IDs[7719.], dummy_kernel)
+    PD_kernels.set_pop_kernel(PD_kernels.pop_IDs[7722.], dummy_kernel)
 
     PD_kernels.update(dummy_buffer)
     PD_kernels.plot_final_results('dummy_control')